@@ -1,16 +1,48 @@
 import os
+import atexit
 import hashlib
+import time
 import psycopg
-from datetime import datetime
-from flask import Flask, request, jsonify, render_template
+from psycopg.rows import dict_row
+from psycopg.types.json import Json
+from psycopg_pool import ConnectionPool
+from flask import Flask, Response, g, request, render_template
+from flask.json.provider import JSONProvider
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import cloudinary
+import cloudinary.api
+import cloudinary.api_client.call_api
 import cloudinary.uploader
+import cloudinary.utils
+import queue
+import urllib3
 import logging
+import orjson
+import threading
+from cachetools import TTLCache
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
 logging.basicConfig(level=logging.INFO)
 
+class OrjsonProvider(JSONProvider):
+    # covers request.get_json and anything else routed through Flask's
+    # JSON machinery; the ojson helper handles the response hot paths
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+MAX_IMAGES_PER_UPLOAD = 6
+# ✅ Werkzeug rejects oversized bodies before any handler code runs;
+# the cap covers a full multi-image request, per-file limits apply in the route
+app.config["MAX_CONTENT_LENGTH"] = MAX_IMAGES_PER_UPLOAD * MAX_IMAGE_BYTES + 64 * 1024
 
 # --- Config (from env) ---
 DB_HOST = os.getenv("DB_HOST")
@@ -25,89 +57,274 @@ cloudinary.config(
     api_secret=os.getenv("CLOUDINARY_API_SECRET")
 )
 
+# ✅ the SDK's default PoolManagers keep one pooled socket per host, so
+# concurrent upload/destroy calls paid a fresh TLS handshake each; a wider
+# pool keeps the connections alive across requests. The admin API reads the
+# call_api module's _http on every call; it gets the same connector.
+_cloudinary_http = urllib3.PoolManager(
+    num_pools=4, maxsize=32,
+    retries=urllib3.Retry(total=3, backoff_factor=0.1),
+    **cloudinary.CERT_KWARGS
+)
+cloudinary.uploader._http = _cloudinary_http
+cloudinary.api_client.call_api._http = _cloudinary_http
+
+# --- Cloudinary background work ---
+# ✅ parallel uploads run here; the client never waits on destroys
+CLOUDINARY_PARALLEL = int(os.getenv("CLOUDINARY_PARALLEL", "8"))
+_cloudinary_executor = ThreadPoolExecutor(max_workers=CLOUDINARY_PARALLEL, thread_name_prefix="cld")
+# caps concurrent outbound uploads across all request threads, executor or not
+_upload_sem = threading.BoundedSemaphore(CLOUDINARY_PARALLEL)
+atexit.register(_cloudinary_executor.shutdown, wait=True)
+
+# ✅ old assets are destroyed in batches of up to 100 through the admin
+# API instead of one HTTPS call per asset; failed batches are re-enqueued
+# (up to 3 attempts per id) rather than leaked
+_destroy_queue = queue.Queue()
+_DESTROY_MAX_ATTEMPTS = 3
+
+def _destroy_worker():
+    while True:
+        batch = [_destroy_queue.get()]
+        try:
+            while len(batch) < 100:
+                batch.append(_destroy_queue.get(timeout=2))
+        except queue.Empty:
+            pass
+        try:
+            cloudinary.api.delete_resources([pid for pid, _ in batch])
+        except Exception as e:
+            retry = [(pid, attempt + 1) for pid, attempt in batch if attempt < _DESTROY_MAX_ATTEMPTS]
+            logging.warning(
+                "Cloudinary batch delete failed for %s ids (%s given up): %s",
+                len(batch), len(batch) - len(retry), e
+            )
+            time.sleep(2)  # don't hot-loop while the API is unreachable
+            for item in retry:
+                _destroy_queue.put(item)
+
+threading.Thread(target=_destroy_worker, daemon=True, name="cld-destroy").start()
+
+def destroy_async(public_id):
+    _destroy_queue.put((public_id, 1))
+
 # --- DB helpers ---
+# ✅ one shared pool instead of a TCP+auth handshake per request
+pool = ConnectionPool(
+    conninfo="",
+    kwargs={
+        "host": DB_HOST, "dbname": DB_NAME,
+        "user": DB_USER, "password": DB_PASS, "port": DB_PORT,
+        "autocommit": True,
+        # prepare every recurring statement on first execution
+        "prepare_threshold": 0
+    },
+    min_size=int(os.getenv("PG_POOL_MIN", "4")),
+    max_size=int(os.getenv("PG_POOL_MAX", "20")),
+    num_workers=2
+)
+atexit.register(pool.close)
+
+try:
+    pool.wait(timeout=10)
+except Exception as e:
+    logging.warning("DB pool not ready yet: %s", e)
+
 def get_conn():
-    return psycopg.connect(
-        host=DB_HOST, dbname=DB_NAME,
-        user=DB_USER, password=DB_PASS, port=DB_PORT,
-        autocommit=True  # ✅ auto-commit enabled
-    )
+    return pool.connection()
+
+# ✅ polling clients re-read the same row every couple of seconds; a tiny
+# TTL cache collapses those reads into one DB round trip
+_get_cache = TTLCache(maxsize=10_000, ttl=2)
+_get_cache_lock = threading.Lock()
+
+def _invalidate_cache(network_id):
+    with _get_cache_lock:
+        _get_cache.pop(network_id, None)
 
 def init_db():
     try:
         with get_conn() as conn, conn.cursor() as cur:
             cur.execute("""
             CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                network_id VARCHAR(128) UNIQUE NOT NULL,
+                network_id BYTEA PRIMARY KEY,
                 text TEXT,
                 image_url TEXT,
                 public_id TEXT,
+                image_urls JSONB,
                 owner_device_id VARCHAR(128),
                 updated_at TIMESTAMP DEFAULT NOW()
             );
             """)
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_network_id ON messages (network_id);")
+            cur.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS image_urls JSONB;")
+            # UNIQUE(network_id) already creates the lookup index;
+            # the extra idx_network_id only added write amplification
+            cur.execute("DROP INDEX IF EXISTS idx_network_id;")
+            # one-shot migration for databases created with the hex VARCHAR key
+            try:
+                cur.execute("ALTER TABLE messages ALTER COLUMN network_id TYPE BYTEA USING decode(network_id, 'hex');")
+            except psycopg.Error:
+                pass  # already BYTEA
     except Exception as e:
         logging.error("DB init error: %s", e)
 
-init_db()
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the messages table and indexes (run once at deploy time)."""
+    init_db()
+
+# for platforms without a release/migrate phase (e.g. Render free tier)
+if os.getenv("RUN_MIGRATIONS") == "1":
+    init_db()
 
 # --- Helpers: network id & headers ---
+_HEADERLESS_ENDPOINTS = {"ping", "index", "static"}
+
+@app.before_request
+def load_request_headers():
+    # ✅ one pass over the environ instead of a header scan per helper call;
+    # probes and static assets skip it entirely
+    if request.endpoint in _HEADERLESS_ENDPOINTS:
+        return
+    headers = request.headers
+    g.xff = headers.get("X-Forwarded-For")
+    g.local_subnet = headers.get("X-Local-Subnet")
+    g.device_id = headers.get("X-Device-ID")
+
 def get_public_ip():
-    ip = request.headers.get("X-Forwarded-For", request.remote_addr)
+    ip = g.xff or request.remote_addr
     if ip:
         ip = ip.split(",")[0].strip()
     return ip or "unknown"
 
 def get_local_subnet():
     # client may send X-Local-Subnet header (e.g., "192.168.1")
-    return request.headers.get("X-Local-Subnet")
+    return g.local_subnet
 
+@lru_cache(maxsize=4096)  # ✅ amortize hashing across repeat clients
 def make_network_id(public_ip, local_subnet):
     raw = f"{public_ip}|{local_subnet}" if local_subnet else f"{public_ip}|"
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    # identifier hash, not a security token: blake2b-128 is faster than
+    # sha256; the raw digest goes straight into the BYTEA column so index
+    # keys are 16-byte memcmp instead of 64-char strcmp
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).digest()
 
 def get_network_id():
-    return make_network_id(get_public_ip(), get_local_subnet())
+    # hash at most once per request
+    nid = getattr(g, "network_id", None)
+    if nid is None:
+        nid = make_network_id(get_public_ip(), get_local_subnet())
+        g.network_id = nid
+    return nid
 
 def get_device_id():
-    return request.headers.get("X-Device-ID")
+    return g.device_id
 
-def iso_or_none(dt):
-    return dt.isoformat() if dt else None
+def ojson(obj, status=200):
+    # orjson serializes datetimes natively and is much faster than jsonify
+    return Response(
+        orjson.dumps(obj, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC),
+        status=status, mimetype="application/json"
+    )
+
+def _save_images(network_id, device_id, uploaded):
+    # ✅ the same round trip returns the replaced assets so they can
+    # be destroyed instead of leaking in Cloudinary
+    with get_conn() as conn, conn.cursor(binary=True) as cur:
+        cur.execute("""
+            WITH old AS (
+                SELECT public_id, image_urls FROM messages WHERE network_id = %s
+            )
+            INSERT INTO messages (network_id, image_url, public_id, image_urls, owner_device_id, updated_at)
+            VALUES (%s, %s, %s, %s, %s, NOW())
+            ON CONFLICT (network_id) DO UPDATE
+            SET image_url = EXCLUDED.image_url,
+                public_id = EXCLUDED.public_id,
+                image_urls = EXCLUDED.image_urls,
+                owner_device_id = EXCLUDED.owner_device_id,
+                updated_at = NOW()
+            WHERE messages.public_id IS DISTINCT FROM EXCLUDED.public_id
+               OR messages.image_urls IS DISTINCT FROM EXCLUDED.image_urls
+               OR messages.owner_device_id IS DISTINCT FROM EXCLUDED.owner_device_id
+            RETURNING (SELECT public_id FROM old), (SELECT image_urls FROM old)
+        """, (network_id, network_id, uploaded[0]["url"], uploaded[0]["public_id"], Json(uploaded), device_id))
+        row = cur.fetchone()
+    if row is None:
+        return  # identical retry: no row rewrite, nothing to invalidate
+    old_pid, old_images = row
+    _invalidate_cache(network_id)
+    for pid in {i["public_id"] for i in (old_images or []) if i.get("public_id")} | ({old_pid} if old_pid else set()):
+        destroy_async(pid)
+
+def image_too_large(f):
+    # content_length is often unset on FileStorage; measure via seek instead
+    pos = f.stream.tell()
+    f.stream.seek(0, os.SEEK_END)
+    size = f.stream.tell()
+    f.stream.seek(pos)
+    return size > MAX_IMAGE_BYTES
+
+def sniff_image_type(f):
+    # the multipart mimetype is client-supplied; trust the magic bytes instead
+    head = f.stream.read(16)
+    f.stream.seek(0)
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if head[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    return None
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_too_large(e):
+    # keep the JSON error shape when Werkzeug aborts at MAX_CONTENT_LENGTH
+    return ojson({"success": False, "error": "Image too large"}, 413)
 
 # --- Routes ---
 
+# ✅ health probes hit this every few seconds; serve pre-serialized bytes
+_PING_BODY = b'{"status":"ok"}'
+
 @app.route("/ping")
 def ping():
-    return jsonify({"status": "ok"})  # ✅ health check route
+    return Response(_PING_BODY, mimetype="application/json")
 
 @app.route("/get", methods=["GET"])
 def get_message():
     network_id = get_network_id()
-    try:
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute(
-                "SELECT text, image_url, public_id, owner_device_id, updated_at FROM messages WHERE network_id = %s",
-                (network_id,)
-            )
-            row = cur.fetchone()
-            if not row:
-                return jsonify({"success": False, "error": "No message found"}), 404
-
-            text, image_url, public_id, owner_device_id, updated_at = row
-            return jsonify({
-                "success": True,
-                "text": text,
-                "image_url": image_url,
-                "public_id": public_id,
-                "owner_device_id": owner_device_id,
-                "updated_at": iso_or_none(updated_at)
-            })
-    except Exception:
-        logging.exception("DB error in /get")
-        return jsonify({"success": False, "error": "Database error"}), 500
+    with _get_cache_lock:
+        row = _get_cache.get(network_id)
+    if row is None:
+        try:
+            with get_conn() as conn, conn.cursor(binary=True, row_factory=dict_row) as cur:
+                cur.execute(
+                    "SELECT text, image_url, public_id, image_urls, owner_device_id, updated_at FROM messages WHERE network_id = %s",
+                    (network_id,)
+                )
+                row = cur.fetchone()
+        except Exception:
+            logging.exception("DB error in /get")
+            return ojson({"success": False, "error": "Database error"}, 500)
+        if not row:
+            return ojson({"success": False, "error": "No message found"}, 404)
+        with _get_cache_lock:
+            _get_cache[network_id] = row
+
+    # ✅ pollers that already hold the latest version get a bodyless 304
+    updated_at = row.get("updated_at")
+    etag = f'W/"{updated_at.timestamp():.6f}"' if updated_at else None
+    if etag and request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers={"ETag": etag})
+
+    body = {"success": True, **row}
+    body["images"] = body.pop("image_urls") or []
+    resp = ojson(body)
+    if etag:
+        resp.headers["ETag"] = etag
+    return resp
 
 @app.route("/set", methods=["POST"])
 def set_text():
@@ -117,10 +334,10 @@ def set_text():
         payload = request.get_json(force=True)
         new_text = payload.get("text", "") if isinstance(payload, dict) else ""
     except Exception:
-        return jsonify({"success": False, "error": "Invalid JSON"}), 400
+        return ojson({"success": False, "error": "Invalid JSON"}, 400)
 
     try:
-        with get_conn() as conn, conn.cursor() as cur:
+        with get_conn() as conn, conn.cursor(binary=True) as cur:
             cur.execute("""
                 INSERT INTO messages (network_id, text, owner_device_id, updated_at)
                 VALUES (%s, %s, %s, NOW())
@@ -128,55 +345,116 @@ def set_text():
                 SET text = EXCLUDED.text,
                     owner_device_id = EXCLUDED.owner_device_id,
                     updated_at = NOW()
+                WHERE messages.text IS DISTINCT FROM EXCLUDED.text
             """, (network_id, new_text, device_id))
-        return jsonify({"success": True})
+            changed = cur.rowcount > 0
+        # idempotent re-sends touch neither the heap nor the cache
+        if changed:
+            _invalidate_cache(network_id)
+        return ojson({"success": True})
     except Exception:
         logging.exception("DB error in /set")
-        return jsonify({"success": False, "error": "Database error"}), 500
+        return ojson({"success": False, "error": "Database error"}, 500)
 
 @app.route("/upload_image", methods=["POST"])
 def upload_image():
     network_id = get_network_id()
     device_id = get_device_id()
 
-    if 'image' not in request.files:
-        return jsonify({"success": False, "error": "No file uploaded"}), 400
-
-    file = request.files['image']
-    if file.filename == '':
-        return jsonify({"success": False, "error": "Empty filename"}), 400
-
-    safe_name = secure_filename(file.filename)
-    timestamp = int(datetime.utcnow().timestamp() * 1000)
-    pub_id = f"{network_id[:16]}_{timestamp}_{safe_name}"
+    # reject on the declared length before parsing the multipart body
+    if request.content_length and request.content_length > app.config["MAX_CONTENT_LENGTH"]:
+        return ojson({"success": False, "error": "Image too large"}, 413)
+
+    files = [f for f in request.files.getlist('image') if f.filename]
+    if not files:
+        return ojson({"success": False, "error": "No file uploaded"}, 400)
+    if len(files) > MAX_IMAGES_PER_UPLOAD:
+        return ojson({"success": False, "error": "Too many images"}, 413)
+
+    for f in files:
+        if image_too_large(f):
+            return ojson({"success": False, "error": "Image too large"}, 413)
+        if sniff_image_type(f) is None:
+            return ojson({"success": False, "error": "Unsupported image type"}, 400)
+
+    def _upload(f):
+        safe_name = secure_filename(f.filename)
+        timestamp = time.time_ns() // 1_000_000
+        pub_id = f"{network_id.hex()[:16]}_{timestamp}_{safe_name}"
+        # ✅ stream in chunks instead of buffering the whole file in memory
+        with _upload_sem:
+            result = cloudinary.uploader.upload_large(
+                f.stream, public_id=pub_id, overwrite=True,
+                resource_type="image",
+                chunk_size=6 * 1024 * 1024  # Cloudinary requires chunks >= 5 MB
+            )
+        return {"url": result.get("secure_url"), "public_id": result.get("public_id")}
 
     try:
-        upload_result = cloudinary.uploader.upload(file, public_id=pub_id, overwrite=True)
-        public_url = upload_result.get("secure_url")
-        public_id = upload_result.get("public_id")
+        if len(files) == 1:
+            uploaded = [_upload(files[0])]
+        else:
+            # ✅ N images upload concurrently instead of back-to-back
+            uploaded = list(_cloudinary_executor.map(_upload, files))
     except Exception:
         logging.exception("Cloudinary upload failed")
-        return jsonify({"success": False, "error": "Image upload failed"}), 500
+        return ojson({"success": False, "error": "Image upload failed"}, 500)
+
+    public_url = uploaded[0]["url"]
+    public_id = uploaded[0]["public_id"]
 
     try:
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO messages (network_id, image_url, public_id, owner_device_id, updated_at)
-                VALUES (%s, %s, %s, %s, NOW())
-                ON CONFLICT (network_id) DO UPDATE
-                SET image_url = EXCLUDED.image_url,
-                    public_id = EXCLUDED.public_id,
-                    owner_device_id = EXCLUDED.owner_device_id,
-                    updated_at = NOW()
-            """, (network_id, public_url, public_id, device_id))
-        return jsonify({"success": True, "image_url": public_url, "public_id": public_id})
+        _save_images(network_id, device_id, uploaded)
+        return ojson({"success": True, "image_url": public_url, "public_id": public_id, "images": uploaded})
     except Exception:
         logging.exception("DB error in /upload_image")
-        try:
-            cloudinary.uploader.destroy(public_id)  # cleanup orphan
-        except Exception:
-            pass
-        return jsonify({"success": False, "error": "Database error"}), 500
+        for item in uploaded:  # cleanup orphans
+            destroy_async(item["public_id"])
+        return ojson({"success": False, "error": "Database error"}, 500)
+
+# ✅ signed direct uploads: the browser posts bytes straight to Cloudinary,
+# so workers never shuffle image data; /upload_image stays as the fallback
+@app.route("/upload_signature", methods=["GET"])
+def upload_signature():
+    network_id = get_network_id()
+    cfg = cloudinary.config()
+    params = {
+        "timestamp": int(time.time()),
+        "public_id": f"{network_id.hex()[:16]}_{time.time_ns() // 1_000_000}"
+    }
+    signature = cloudinary.utils.api_sign_request(params, cfg.api_secret)
+    return ojson({
+        "success": True,
+        "signature": signature,
+        "timestamp": params["timestamp"],
+        "public_id": params["public_id"],
+        "api_key": cfg.api_key,
+        "cloud_name": cfg.cloud_name
+    })
+
+@app.route("/set_image", methods=["POST"])
+def set_image():
+    network_id = get_network_id()
+    device_id = get_device_id()
+    try:
+        payload = request.get_json(force=True)
+        image_url = payload.get("image_url") if isinstance(payload, dict) else None
+        public_id = payload.get("public_id") if isinstance(payload, dict) else None
+    except Exception:
+        return ojson({"success": False, "error": "Invalid JSON"}, 400)
+
+    if not image_url or not public_id:
+        return ojson({"success": False, "error": "image_url and public_id required"}, 400)
+    # the signature endpoint only mints ids prefixed with this network's key
+    if not public_id.startswith(network_id.hex()[:16]):
+        return ojson({"success": False, "error": "public_id does not belong to this network"}, 403)
+
+    try:
+        _save_images(network_id, device_id, [{"url": image_url, "public_id": public_id}])
+        return ojson({"success": True, "image_url": image_url, "public_id": public_id})
+    except Exception:
+        logging.exception("DB error in /set_image")
+        return ojson({"success": False, "error": "Database error"}, 500)
 
 @app.route("/delete_image", methods=["POST"])
 def delete_image():
@@ -184,30 +462,43 @@ def delete_image():
     device_id = get_device_id()
 
     try:
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute("SELECT public_id, owner_device_id FROM messages WHERE network_id = %s", (network_id,))
-            row = cur.fetchone()
-            if not row or not row[0]:
-                cur.execute("UPDATE messages SET image_url = NULL, public_id = NULL, updated_at = NOW() WHERE network_id = %s", (network_id,))
-                return jsonify({"success": True, "deleted": False})
-
-            public_id, owner_device = row
-            if owner_device and device_id and owner_device != device_id:
-                return jsonify({"success": False, "error": "Only owner may delete image"}), 403
-
-            try:
-                cloudinary.uploader.destroy(public_id)
-            except Exception as e:
-                logging.warning("Cloudinary delete failed for %s: %s", public_id, e)
-
+        with get_conn() as conn, conn.cursor(binary=True) as cur:
+            # ✅ single round trip: read old state, check ownership and
+            # clear the image in one statement
             cur.execute("""
-                UPDATE messages SET image_url = NULL, public_id = NULL, updated_at = NOW()
-                WHERE network_id = %s
-            """, (network_id,))
-        return jsonify({"success": True, "deleted": True})
+                WITH old AS (
+                    SELECT public_id, image_urls, owner_device_id FROM messages WHERE network_id = %s
+                ), upd AS (
+                    UPDATE messages SET image_url = NULL, public_id = NULL, image_urls = NULL, updated_at = NOW()
+                    WHERE network_id = %s
+                      AND NOT EXISTS (
+                          SELECT 1 FROM old
+                          WHERE old.owner_device_id IS NOT NULL
+                            AND %s::text IS NOT NULL
+                            AND old.owner_device_id <> %s
+                      )
+                    RETURNING 1
+                )
+                SELECT old.public_id, old.image_urls, EXISTS (SELECT 1 FROM upd) FROM old
+            """, (network_id, network_id, device_id, device_id))
+            row = cur.fetchone()
+            if not row:
+                return ojson({"success": True, "deleted": False})
+
+            public_id, image_urls, updated = row
+            if updated:
+                _invalidate_cache(network_id)
+            if not updated:
+                return ojson({"success": False, "error": "Only owner may delete image"}, 403)
+            if not public_id and not image_urls:
+                return ojson({"success": True, "deleted": False})
+
+            for pid in {item["public_id"] for item in (image_urls or []) if item.get("public_id")} | ({public_id} if public_id else set()):
+                destroy_async(pid)
+        return ojson({"success": True, "deleted": True})
     except Exception:
         logging.exception("DB error in /delete_image")
-        return jsonify({"success": False, "error": "Database error"}), 500
+        return ojson({"success": False, "error": "Database error"}, 500)
 
 @app.route("/")
 def index():